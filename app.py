@@ -8,32 +8,200 @@
 # 5. Exports the final result to Excel
 
 # REQUIREMENTS:
-# pip install pytesseract pdfplumber pandas openpyxl pillow rapidfuzz streamlit
+# pip install pytesseract pdfplumber pandas numpy xlsxwriter python-calamine pillow rapidfuzz pyarrow streamlit
 # Install Tesseract OCR engine separately (system-level)
 
+import hashlib
+import heapq
+import os
+import re
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
 import streamlit as st
-import pdfplumber
 import pandas as pd
+import numpy as np
 from PIL import Image
-import pytesseract
-from rapidfuzz import process, fuzz
+
+# pdfplumber, pytesseract and rapidfuzz are imported inside the functions
+# that use them so the landing page renders before they are loaded
+
+# Tesseract's own OpenMP threading is slower than running one
+# single-threaded Tesseract per core, which is what OCR below does
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
 
 # ---------------------- CONFIG ----------------------
 st.set_page_config(page_title="Invoice to Excel Converter", layout="wide")
 st.title("📄 Invoice to Excel Converter with HS Code Mapping")
 
+# DPI used when rasterizing scanned PDF pages for OCR
+OCR_RESOLUTION = 300
+
+# LSTM-only engine, single uniform text block layout, English
+TESSERACT_CONFIG = "--oem 1 --psm 6 -l eng"
+
+# Seconds allowed per page before a Tesseract call is aborted
+OCR_TIMEOUT = 30
+
+# Extracted invoice text is kept in memory only, for at most this many
+# invoices and this many seconds
+OCR_CACHE_ENTRIES = 50
+OCR_CACHE_TTL = 3600
+
+# Loaded HS catalogs are kept in memory for at most this many distinct
+# files and this many seconds
+HS_CACHE_ENTRIES = 5
+HS_CACHE_TTL = 3600
+
+# Max number of fuzzy results remembered per session
+FUZZY_CACHE_SIZE = 5000
+
+# Minimum token_set_ratio score for an HS description to count as a match
+MATCH_SCORE_CUTOFF = 70
+
+# Catalogs larger than this are narrowed with a token index before
+# fuzzy scoring, keeping only the top-K rows sharing the rarest tokens.
+# Lines the prefilter cannot match are still scored against the full catalog.
+PREFILTER_MIN_CHOICES = 2000
+PREFILTER_TOP_K = 50
+
+# Header/footer lines to skip and hints that a line is an item row,
+# matched case-insensitively by the vectorized parser (Arrow's RE2).
+# Plain substring alternations (no word boundaries) keep the original
+# "keyword in line" checks. RE2's \d is ASCII-only, so digits are matched
+# with Unicode classes instead: \p{Nd} covers full-width and Arabic-Indic
+# digits and \p{No} covers superscripts like "m²", as str.isdigit() did.
+HEADER_PATTERN = r"invoice|tax|bill to|ship to|date|total|subtotal|amount in words|bank"
+ITEM_PATTERN = r"qty|quantity|[\p{Nd}\p{No}]"
+
+# Product keywords repeated onto invoice descriptions to weight HS matching
+KEYWORD_RE = re.compile(
+    r"elbow|tee|coupling|adapter|union|pipe|pvc|fitting|valve"
+)
+
 # ---------------------- FUNCTIONS ----------------------
-def extract_text_from_pdf(pdf_file):
-    text = ""
-    with pdfplumber.open(pdf_file) as pdf:
-        for page in pdf.pages:
-            text += page.extract_text() or ""
-    return text
+def file_digest(file_bytes):
+    """Short BLAKE2b content hash used as a cache key for uploads."""
+    return hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+
+
+def extract_text_from_pdf(file_bytes):
+    import pdfplumber
+
+    parts = []
+    scanned = {}
+    with pdfplumber.open(BytesIO(file_bytes)) as pdf:
+        for i, page in enumerate(pdf.pages):
+            page_text = page.extract_text() or ""
+            if not page_text.strip():
+                # Scanned page without a text layer, OCR it below. Keep it as
+                # 1-bit (~1 MB per A4 page at 300 DPI, vs ~25 MB for RGB)
+                scanned[i] = binarize(page.to_image(resolution=OCR_RESOLUTION).original)
+            parts.append(page_text)
+            # Release parsed page objects to bound memory on long PDFs
+            page.flush_cache()
+
+    # Text-only PDFs never load pytesseract
+    if scanned:
+        for i, page_text in zip(scanned, extract_text_from_images(list(scanned.values()))):
+            parts[i] = page_text
+
+    return "\n".join(parts)
+
+
+def binarize(image):
+    """Converts an image to black and white using Otsu's threshold."""
+    if image.mode == "1":
+        return image
+    if image.mode == "P" and "transparency" in image.info:
+        image = image.convert("RGBA")
+    if "A" in image.getbands():
+        # Flatten transparency onto white, otherwise transparent pixels turn black
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    gray = image.convert("L")
+    hist = np.asarray(gray.histogram(), dtype=np.float64)
+    p = hist / hist.sum()
+    omega = np.cumsum(p)
+    mu = np.cumsum(p * np.arange(256))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (mu[-1] * omega - mu) ** 2 / (omega * (1 - omega))
+    threshold = int(np.argmax(np.nan_to_num(between)))
+    return gray.point([0 if v <= threshold else 255 for v in range(256)], "1")
+
+
+def ocr_batch(images):
+    """
+    OCRs a list of PIL images with a single Tesseract invocation so the
+    engine start-up cost is paid once instead of once per page.
+    Returns one text per image, in order.
+    """
+    if not images:
+        return []
+
+    import pytesseract
+
+    # Clean 1-bit input is smaller and faster for Tesseract's LSTM
+    images = [binarize(image) for image in images]
+    timeout = OCR_TIMEOUT * len(images)
+
+    if len(images) == 1:
+        return [pytesseract.image_to_string(images[0], config=TESSERACT_CONFIG, timeout=timeout)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        for i, image in enumerate(images):
+            path = os.path.join(tmp_dir, f"page_{i}.png")
+            image.save(path)
+            paths.append(path)
+
+        # Tesseract treats a .txt input as a list of image paths
+        list_path = os.path.join(tmp_dir, "pages.txt")
+        with open(list_path, "w") as f:
+            f.write("\n".join(paths))
+
+        text = pytesseract.image_to_string(list_path, config=TESSERACT_CONFIG, timeout=timeout)
+
+    # Pages are separated by form feeds in the combined output
+    texts = text.split("\f")[:len(images)]
+    return texts + [""] * (len(images) - len(texts))
+
+
+def extract_text_from_images(images):
+    """
+    OCRs pages in parallel: images are split into one contiguous chunk
+    per CPU core and each chunk runs in its own Tesseract process.
+    Returns one text per image, in order.
+    """
+    workers = min(len(images), os.cpu_count() or 1)
+    if workers <= 1:
+        return ocr_batch(images)
+
+    size = -(-len(images) // workers)
+    chunks = [images[i:i + size] for i in range(0, len(images), size)]
+    with ThreadPoolExecutor(max_workers=len(chunks)) as ex:
+        results = ex.map(ocr_batch, chunks)
+    return [text for chunk in results for text in chunk]
+
+
+def extract_text_from_image(file_bytes):
+    image = Image.open(BytesIO(file_bytes))
+    return extract_text_from_images([image])[0]
 
 
-def extract_text_from_image(image_file):
-    image = Image.open(image_file)
-    return pytesseract.image_to_string(image)
+@st.cache_data(max_entries=OCR_CACHE_ENTRIES, ttl=OCR_CACHE_TTL, show_spinner=False)
+def extract_invoice_text(digest, is_pdf, _file_bytes):
+    """
+    Extracts invoice text, cached in memory by content digest so the same
+    invoice is not OCRed again while it stays in the cache.
+    _file_bytes is excluded from the cache key (leading underscore).
+    """
+    if is_pdf:
+        return extract_text_from_pdf(_file_bytes)
+    return extract_text_from_image(_file_bytes)
 
 
 def parse_invoice_text(text):
@@ -43,40 +211,46 @@ def parse_invoice_text(text):
     - Detects Description/Item, Qty/Quantity, Origin
     - Extracts only line items
     """
-    rows = []
-    lines = [l.strip() for l in text.split("\n") if l.strip()]
+    lines = pd.Series(text.splitlines(), dtype="string[pyarrow]").str.strip()
+    lines = lines[lines.str.len() > 0]
 
-    header_keywords = [
-        "invoice", "tax", "bill to", "ship to", "date",
-        "total", "subtotal", "amount in words", "bank"
-    ]
+    # Skip header/footer info
+    is_header = lines.str.contains(HEADER_PATTERN, case=False, regex=True)
 
-    for line in lines:
-        low = line.lower()
+    # Likely item lines (contain qty or numbers + text)
+    is_item = lines.str.contains(ITEM_PATTERN, case=False, regex=True)
 
-        # Skip header/footer info
-        if any(h in low for h in header_keywords):
-            continue
+    descriptions = lines[~is_header & is_item].tolist()
 
-        # Likely item lines (contain qty or numbers + text)
-        if any(k in low for k in ["qty", "quantity"]) or any(c.isdigit() for c in line):
-            rows.append({
-                "Full Description": line,
-                "Brand": "",
-                "Model": "",
-                "Size": "",
-                "Qty": "",
-                "Packing": "",
-                "Origin": "",
-                "Total Price": ""
-            })
+    # Build the frame column-wise; other fields stay blank placeholders
+    n = len(descriptions)
+    return pd.DataFrame({
+        "Full Description": descriptions,
+        "Brand": [""] * n,
+        "Model": [""] * n,
+        "Size": [""] * n,
+        "Qty": [""] * n,
+        "Packing": [""] * n,
+        "Origin": [""] * n,
+        "Total Price": [""] * n
+    })
 
-    return pd.DataFrame(rows)
 
+@st.cache_data(max_entries=HS_CACHE_ENTRIES, ttl=HS_CACHE_TTL, show_spinner=False)
+def load_hs(file_bytes):
+    """
+    Loads the HS code Excel file once per distinct upload:
+    - Detects description, hs code and optional unit columns
+    - Preprocesses the descriptions used as fuzzy-match choices
+    Returns (hs_map, choices, desc_col, hs_col, unit_col)
+    """
+    from rapidfuzz import utils
+
+    # calamine (Rust) parses xlsx much faster than openpyxl; needs pandas >= 2.2
+    hs_df = pd.read_excel(BytesIO(file_bytes), engine="calamine")
 
-def map_hs_codes(invoice_df, hs_df):
     # Normalize column names
-    hs_df.columns = [c.strip().lower() for c in hs_df.columns]
+    hs_df.columns = [str(c).strip().lower() for c in hs_df.columns]
 
     # Auto-detect HS code and description columns
     desc_col = None
@@ -101,41 +275,188 @@ def map_hs_codes(invoice_df, hs_df):
     if unit_col:
         select_cols.append(unit_col)
 
-    hs_map = hs_df[select_cols]
+    hs_map = hs_df[select_cols].reset_index(drop=True)
 
-    hs_codes = []
-    hs_descs = []
-    hs_units = []
+    # Arrow-backed strings are stored contiguously instead of as Python objects
+    hs_map[desc_col] = hs_map[desc_col].astype("string[pyarrow]")
+
+    # Preprocess the HS descriptions once (lowercase, strip non-alphanumerics)
+    # so the scorers can run with processor=None
+    choices = [
+        utils.default_process(c)
+        for c in hs_map[desc_col].to_numpy(na_value="").tolist()
+    ]
+
+    return hs_map, choices, desc_col, hs_col, unit_col
+
+
+def normalize_desc(desc):
+    """Lowercase, drop punctuation and collapse whitespace for exact lookups."""
+    return re.sub(r"\W+", " ", str(desc).lower()).strip()
+
+
+@st.cache_resource(max_entries=HS_CACHE_ENTRIES, ttl=HS_CACHE_TTL, show_spinner=False)
+def build_exact_map(file_bytes):
+    """
+    Builds {normalized description: HS row index} for the HS file.
+    The first row wins on duplicates, same as the fuzzy matcher.
+    """
+    _, choices, _, _, _ = load_hs(file_bytes)
+    exact_map = {}
+    for i, desc in enumerate(choices):
+        exact_map.setdefault(normalize_desc(desc), i)
+    return exact_map
+
+
+@st.cache_resource(max_entries=HS_CACHE_ENTRIES, ttl=HS_CACHE_TTL, show_spinner=False)
+def build_token_index(file_bytes):
+    """Builds {token: [HS row indexes]} over the normalized descriptions."""
+    _, choices, _, _, _ = load_hs(file_bytes)
+    token_index = {}
+    for i, desc in enumerate(choices):
+        for token in set(normalize_desc(desc).split()):
+            token_index.setdefault(token, []).append(i)
+    return token_index
+
+
+def prefilter_match(query, choices, token_index):
+    """
+    Scores a query only against catalog rows sharing a token with it.
+    Candidates are ranked by summed inverse document frequency of the
+    shared tokens and the best PREFILTER_TOP_K are fuzzy scored in row
+    order, so equal scores resolve to the first catalog row.
+    Returns (row index, score), or (-1, 0) when no row shares a token
+    or none clears MATCH_SCORE_CUTOFF.
+    """
+    from rapidfuzz import process, fuzz
+
+    # Tokens in query order (not set order) so results don't depend on the hash seed
+    weights = {}
+    for token in dict.fromkeys(normalize_desc(query).split()):
+        rows = token_index.get(token)
+        if not rows:
+            continue
+        weight = 1 / len(rows)
+        for i in rows:
+            weights[i] = weights.get(i, 0) + weight
+
+    if not weights:
+        return -1, 0
+
+    # Ties go to the lowest row index, same as the full cdist matcher
+    candidates = sorted(heapq.nlargest(
+        PREFILTER_TOP_K, weights, key=lambda i: (weights[i], -i)
+    ))
+    match = process.extractOne(
+        query,
+        [choices[i] for i in candidates],
+        scorer=fuzz.token_set_ratio,
+        processor=None,
+        score_cutoff=MATCH_SCORE_CUTOFF
+    )
+    if match is None:
+        return -1, 0
+    return candidates[match[2]], match[1]
+
+
+def get_fuzzy_cache(file_bytes):
+    """Per-session LRU of fuzzy results, reset when the HS file changes."""
+    key = file_digest(file_bytes)
+    if st.session_state.get("fuzzy_cache_key") != key:
+        st.session_state["fuzzy_cache_key"] = key
+        st.session_state["fuzzy_cache"] = OrderedDict()
+    return st.session_state["fuzzy_cache"]
+
+
+def map_hs_codes(invoice_df, hs_map, choices, desc_col, hs_col, unit_col,
+                 exact_map=None, fuzzy_cache=None, token_index=None):
+    from rapidfuzz import process, fuzz, utils
+
+    exact_map = exact_map if exact_map is not None else {}
+    fuzzy_cache = fuzzy_cache if fuzzy_cache is not None else OrderedDict()
+
+    # Row index into hs_map for every invoice line, -1 = not found
+    row_idx = []
+    queries = []
+    # Invoice rows waiting on each distinct unmatched description, so
+    # repeated lines are fuzzy matched only once
+    pending = {}
 
     for desc in invoice_df["Full Description"]:
+        key = normalize_desc(desc)
+
+        # Exact match or previously fuzzy-matched description
+        idx = exact_map.get(key)
+        if idx is None and key in fuzzy_cache:
+            fuzzy_cache.move_to_end(key)
+            idx = fuzzy_cache[key]
+        if idx is not None:
+            row_idx.append(idx)
+            continue
+
+        if key in pending:
+            pending[key].append(len(row_idx))
+            row_idx.append(-1)
+            continue
+
         # Pre-clean invoice description for better HS matching
         clean_desc = desc.lower()
-        keywords = [
-            "elbow", "tee", "coupling", "adapter", "union",
-            "pipe", "pvc", "fitting", "valve"
-        ]
-        for k in keywords:
-            if k in clean_desc:
-                clean_desc += f" {k}"
-
-        match = process.extractOne(
-            clean_desc,
-            hs_map[desc_col].str.lower(),
-            scorer=fuzz.token_set_ratio
+        hits = KEYWORD_RE.findall(clean_desc)
+        if hits:
+            clean_desc += " " + " ".join(dict.fromkeys(hits))
+        queries.append(utils.default_process(clean_desc))
+        pending[key] = [len(row_idx)]
+        row_idx.append(-1)
+
+    best_idx = [-1] * len(queries)
+    best_score = [0] * len(queries)
+    # Queries that still need scoring against the whole catalog
+    full = list(range(len(queries))) if choices else []
+
+    if full and token_index is not None and len(choices) > PREFILTER_MIN_CHOICES:
+        # Large catalog: first only score rows that share rare tokens with each line
+        for i, q in enumerate(queries):
+            best_idx[i], best_score[i] = prefilter_match(q, choices, token_index)
+        # Lines the prefilter could not match fall back to the full scan below
+        full = [i for i in full if best_idx[i] < 0]
+
+    if full:
+        # Score the remaining invoice lines against every HS description in one native call
+        scores = process.cdist(
+            [queries[i] for i in full],
+            choices,
+            scorer=fuzz.token_set_ratio,
+            processor=None,
+            score_cutoff=MATCH_SCORE_CUTOFF,
+            workers=-1,
+            dtype=np.uint8
         )
-        if match and match[1] > 70:
-            row = hs_map.iloc[match[2]]
-            hs_codes.append(row[hs_col])
-            hs_descs.append(row[desc_col])
-            hs_units.append(row[unit_col] if unit_col else "")
-        else:
-            hs_codes.append("NOT FOUND")
-            hs_descs.append("NOT FOUND")
-            hs_units.append("")
-
-    invoice_df["HS Code"] = hs_codes
-    invoice_df["HS Description"] = hs_descs
-    invoice_df["Unit"] = hs_units
+        for i, idx, score in zip(full, scores.argmax(axis=1), scores.max(axis=1)):
+            best_idx[i], best_score[i] = idx, score
+
+    for (key, rows), idx, score in zip(pending.items(), best_idx, best_score):
+        idx = int(idx) if score >= MATCH_SCORE_CUTOFF else -1
+        for row in rows:
+            row_idx[row] = idx
+        fuzzy_cache[key] = idx
+        fuzzy_cache.move_to_end(key)
+        if len(fuzzy_cache) > FUZZY_CACHE_SIZE:
+            fuzzy_cache.popitem(last=False)
+
+    # Gather the matched HS columns with one numpy take per column
+    row_idx = np.asarray(row_idx, dtype=np.intp)
+    found = row_idx >= 0
+
+    def gather(col, missing):
+        out = np.full(len(row_idx), missing, dtype=object)
+        if col:
+            # Take the matched rows first so only N values become Python objects
+            out[found] = hs_map[col].iloc[row_idx[found]].to_numpy(dtype=object)
+        return out
+
+    invoice_df["HS Code"] = gather(hs_col, "NOT FOUND")
+    invoice_df["HS Description"] = gather(desc_col, "NOT FOUND")
+    invoice_df["Unit"] = gather(unit_col, "")
     return invoice_df
 
 # ---------------------- UI ----------------------
@@ -143,27 +464,44 @@ invoice_file = st.file_uploader("Upload Invoice (PDF or Image)", type=["pdf", "p
 hs_file = st.file_uploader("Upload HS Code Excel File", type=["xlsx"])
 
 if invoice_file and hs_file:
-    if invoice_file.type == "application/pdf":
-        raw_text = extract_text_from_pdf(invoice_file)
-    else:
-        raw_text = extract_text_from_image(invoice_file)
+    invoice_bytes = invoice_file.getvalue()
+    raw_text = extract_invoice_text(
+        file_digest(invoice_bytes),
+        invoice_file.type == "application/pdf",
+        invoice_bytes
+    )
 
     st.subheader("📄 Extracted Text Preview")
     st.text(raw_text[:3000])
 
     invoice_df = parse_invoice_text(raw_text)
 
-    hs_df = pd.read_excel(hs_file)
-    final_df = map_hs_codes(invoice_df, hs_df)
+    hs_bytes = hs_file.getvalue()
+    hs_map, choices, desc_col, hs_col, unit_col = load_hs(hs_bytes)
+    final_df = map_hs_codes(
+        invoice_df, hs_map, choices, desc_col, hs_col, unit_col,
+        exact_map=build_exact_map(hs_bytes),
+        fuzzy_cache=get_fuzzy_cache(hs_bytes),
+        token_index=build_token_index(hs_bytes)
+    )
 
     st.subheader("📊 Invoice Table")
     st.dataframe(final_df, use_container_width=True)
 
-    output_file = "invoice_with_hs_codes.xlsx"
-    final_df.to_excel(output_file, index=False)
-
-    with open(output_file, "rb") as f:
-        st.download_button("⬇ Download Excel File", f, file_name=output_file)
+    # Build the workbook in memory instead of a temp file on disk.
+    # constant_memory is not used: pandas writes column by column and
+    # that mode drops cells written to rows that were already flushed
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+        final_df.to_excel(writer, index=False)
+    output.seek(0)
+
+    st.download_button(
+        "⬇ Download Excel File",
+        output,
+        file_name="invoice_with_hs_codes.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
 
 # ---------------------- NOTES ----------------------
 # - HS Excel file MUST have columns:
@@ -171,3 +509,10 @@ if invoice_file and hs_file:
 # - Parsing rules can be customized per supplier
 # - Accuracy improves with clean invoices
 # - This can be upgraded with AI/NLP later
+# - Extracted invoice text is cached in server memory only, for up to
+#   OCR_CACHE_TTL seconds and OCR_CACHE_ENTRIES invoices, shared across
+#   sessions; it is gone when the app restarts. Page images written for
+#   OCR are temporary files deleted as soon as Tesseract finishes
+# - Loaded HS catalogs, their exact-match dicts and token indexes are cached in
+#   server memory for up to HS_CACHE_TTL seconds and HS_CACHE_ENTRIES
+#   distinct files, shared across sessions
@@ -0,0 +1,48 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+pytest.importorskip("streamlit")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import app  # noqa: E402
+
+
+def baseline_item_lines(text):
+    """The original per-line parser logic, before it was vectorized."""
+    header_keywords = [
+        "invoice", "tax", "bill to", "ship to", "date",
+        "total", "subtotal", "amount in words", "bank"
+    ]
+    rows = []
+    for line in [l.strip() for l in text.split("\n") if l.strip()]:
+        low = line.lower()
+        if any(h in low for h in header_keywords):
+            continue
+        if any(k in low for k in ["qty", "quantity"]) or any(c.isdigit() for c in line):
+            rows.append(line)
+    return rows
+
+
+def test_non_ascii_digits_match_isdigit():
+    text = "\n".join([
+        "TAX INVOICE ２０２４",
+        "Pipe ２０mm",
+        "Elbow ٣ pcs",
+        "Coupling ۴ pcs",
+        "PVC sheet m²",
+        "Tee 5",
+        "Union QTY",
+        "Valve brass",
+        "Total ٣٠"
+    ])
+    parsed = app.parse_invoice_text(text)["Full Description"].tolist()
+    assert parsed == baseline_item_lines(text)
+    assert parsed == [
+        "Pipe ２０mm", "Elbow ٣ pcs", "Coupling ۴ pcs",
+        "PVC sheet m²", "Tee 5", "Union QTY"
+    ]